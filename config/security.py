@@ -49,10 +49,14 @@ A tabela 'students' possui as seguintes colunas, organizadas por grupos:
     - Mensal abreviado: jan, feb, mar, apr, may, jun, jul, aug, sep, oct, nov, dec 
     - Mensal extenso: january, february, march, april, mayFull, june, july, august, september, october, november, december 
     - Mensal série 2: january2, february2, march2, april2, may2, june2, july2, august2, september2, october2, november2, december2 
-    Use essas informações para montar queries SQL eficientes quando necessário, e retorne apenas a resposta pedida, sem repetir toda a tabela."""
+    Use essas informações para montar queries SQL eficientes quando necessário, e retorne apenas a resposta pedida, sem repetir toda a tabela.
+Gere somente queries SELECT na tabela "public.students", usando apenas as colunas listadas acima. Nunca gere comandos que alterem dados ou estrutura (INSERT, UPDATE, DELETE, DROP, ALTER, TRUNCATE)."""
+
+# Tabela permitida nas queries geradas (schema public)
+ALLOWED_TABLE = "students"
 
 # Colunas permitidas
-ALLOWED_COLUMNS = {
+ALLOWED_COLUMNS = frozenset({
     "name", "socialname", "preferredname", "ismartemail", "phonenumber", "gender",
     "sexualorientation", "raceethnicity", "hasdisability", "linkedin",
     "transferredcourseoruniversity", "transferdate", "currentcoursestart", "currentcoursestartyear",
@@ -74,7 +78,7 @@ ALLOWED_COLUMNS = {
     "september", "october", "november", "december",
     "january2", "february2", "march2", "april2", "may2", "june2", "july2", "august2",
     "september2", "october2", "november2", "december2"
-}
+})
 
 # Comandos SQL perigosos a bloquear
-DANGEROUS_KEYWORDS = {"drop", "delete", "update", "insert", "alter", "truncate"}
+DANGEROUS_KEYWORDS = frozenset({"drop", "delete", "update", "insert", "alter", "truncate"})
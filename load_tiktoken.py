@@ -0,0 +1,17 @@
+import tiktoken
+
+# -------------------------
+# Pré-carrega os encodings usados pela API
+# -------------------------
+# Rodado no build da imagem com TIKTOKEN_CACHE_DIR definido, para que o
+# primeiro /ask não precise baixar os arquivos BPE em tempo de execução.
+MODELS = ["gpt-4o-mini"]
+ENCODINGS = ["cl100k_base"]  # fallback de _get_encoding em main.py
+
+for model in MODELS:
+    enc = tiktoken.encoding_for_model(model)
+    print(f"[OK] Encoding '{enc.name}' carregado para o modelo '{model}'")
+
+for name in ENCODINGS:
+    tiktoken.get_encoding(name)
+    print(f"[OK] Encoding '{name}' carregado")
@@ -1,23 +1,35 @@
 import logging
 import os
 import asyncio
+import random
 import re
 import time
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Annotated
+from cachetools import TTLCache
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+from pydantic import BaseModel, StringConstraints
 from dotenv import load_dotenv
 from toolfront import Database
 from pydantic_ai.exceptions import ModelRetry
 import tiktoken
 import psycopg
-from urllib.parse import urlparse, parse_qs
-from psycopg_pool import ConnectionPool
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+
+try:
+    import re2 as sql_re  # google-re2: DFA, sem backtracking
+except ImportError:
+    sql_re = re
 
 # -------------------------
 # Configurações externas
 # -------------------------
-from config.security import CONTEXT, ALLOWED_COLUMNS, DANGEROUS_KEYWORDS
+from config.security import CONTEXT, ALLOWED_TABLE, ALLOWED_COLUMNS, DANGEROUS_KEYWORDS
 
 # -------------------------
 # Carregamento de .env
@@ -33,74 +45,116 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(me
 logger = logging.getLogger("toolfront_api")
 
 # -------------------------
-# Pool de conexões com psycopg3
+# Pool de conexões assíncrono com psycopg3
 # -------------------------
 DB_POOL_MIN = 1
 DB_POOL_MAX = 5
 DB_POOL_MAX_LIFETIME = 900  # 15 minutos
-db_pool: ConnectionPool | None = None
+DB_POOL_MAX_IDLE = 300  # 5 minutos
+DB_POOL_CHECK_INTERVAL = 120  # 2 minutos
+DB_POOL_CHECK_JITTER = 30
+DB_PROBE_TIMEOUT = 5  # segundos de espera por uma conexão livre no SELECT 1
+# Parâmetros de conexão: search_path já definido no handshake (sem SET extra)
+# e conexões mortas detectadas pelo TCP keepalive, sem probe a cada checkout
+DB_CONN_KWARGS = {
+    "options": "-c search_path=public",
+    "application_name": "toolfront_api",
+    # O pool só roda probes de leitura: sem BEGIN/COMMIT em volta do SELECT 1
+    "autocommit": True,
+    "keepalives": 1,
+    "keepalives_idle": 30,
+    "keepalives_interval": 10,
+    "keepalives_count": 3
+}
+db_pool: AsyncConnectionPool | None = None
 db: Database | None = None
+# Serializa a recriação do pool e do Database
+db_pool_lock = asyncio.Lock()
 
-def parse_database_url(url: str):
-    parsed = urlparse(url)
-    qs = parse_qs(parsed.query)
-    return {
-        "user": parsed.username,
-        "password": parsed.password,
-        "host": parsed.hostname,
-        "port": parsed.port or 5432,
-        "dbname": parsed.path.lstrip("/"),
-        "sslmode": qs.get("sslmode", ["disable"])[0]
-    }
-
-def init_db_pool():
-    """Inicializa pool e objeto Database"""
-    global db_pool, db
-    if db_pool:
-        db_pool.close()
-    
-    db_pool = ConnectionPool(
-        conninfo=DATABASE_URL,
-        min_size=DB_POOL_MIN,
-        max_size=DB_POOL_MAX
-    )
-
-    # Configura search_path nas conexões iniciais
-    with db_pool.connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SET search_path TO public;")
-
-    db = Database(DATABASE_URL)
-    logger.info("Pool de conexões e Database inicializados.")
-
-def get_conn_from_pool():
-    """Retorna um context manager de conexão válida do pool"""
+async def init_db_pool(stale: AsyncConnectionPool | None = None):
+    """(Re)cria o pool de conexões; ignora o pedido se `stale` já foi substituído"""
     global db_pool
-    if not db_pool:
-        init_db_pool()
-    
-    for _ in range(3):
+    async with db_pool_lock:
+        if stale is not None and db_pool is not stale:
+            return
+        if db_pool:
+            await db_pool.close()
+
+        # O próprio pool descarta conexões ociosas/antigas
+        db_pool = AsyncConnectionPool(
+            conninfo=DATABASE_URL,
+            kwargs=DB_CONN_KWARGS,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            max_idle=DB_POOL_MAX_IDLE,
+            max_lifetime=DB_POOL_MAX_LIFETIME,
+            open=False
+        )
+        await db_pool.open()
+
+        logger.info("Pool de conexões inicializado.")
+
+def init_database():
+    """Cria o objeto Database usado por db.ask"""
+    global db
+    if db is None:
+        db = Database(DATABASE_URL)
+        logger.info("Database inicializado.")
+
+async def reset_database(stale: Database):
+    """Recria o Database após erro de conexão; ignora o pedido se `stale` já foi substituído"""
+    global db
+    async with db_pool_lock:
+        if db is not stale:
+            return
+        loop = asyncio.get_running_loop()
         try:
-            return db_pool.connection()  # <-- retorna o context manager corretamente
+            db = await loop.run_in_executor(None, Database, DATABASE_URL)
         except Exception as e:
+            # Mantém a instância atual; a próxima tentativa de db.ask tenta de novo
+            logger.warning(f"Falha ao reinicializar Database: {e}")
+            return
+        logger.info("Database reinicializado.")
+
+async def get_conn_from_pool(timeout: float | None = None):
+    """Retorna um context manager assíncrono de conexão do pool"""
+    if not db_pool:
+        await init_db_pool()
+    return db_pool.connection(timeout=timeout)
+
+async def ping_db():
+    """Executa SELECT 1; se a conexão estiver morta, recria o pool e tenta mais uma vez"""
+    for attempt in range(2):
+        conn_cm = await get_conn_from_pool(timeout=DB_PROBE_TIMEOUT)
+        pool = db_pool
+        try:
+            async with conn_cm as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute("SELECT 1;")
+            return
+        except PoolTimeout:
+            # Banco inacessível: o pool já tenta reconectar sozinho, recriá-lo não ajuda
+            raise
+        except (psycopg.OperationalError, psycopg.InterfaceError) as e:
+            if attempt:
+                raise
             logger.warning(f"Conexão inválida: {e}. Reinicializando pool...")
-            init_db_pool()
-    raise Exception("Não foi possível obter conexão válida")
+            await init_db_pool(stale=pool)
 
-async def keep_alive():
-    """Executa SELECT 1 periodicamente para evitar timeout"""
+async def check_pool_periodically():
+    """Verifica as conexões ociosas do pool e substitui apenas as quebradas"""
     while True:
+        # Jitter evita que várias réplicas verifiquem o banco ao mesmo tempo
+        await asyncio.sleep(DB_POOL_CHECK_INTERVAL + random.uniform(0, DB_POOL_CHECK_JITTER))
+        if not db_pool:
+            continue
         try:
-            with get_conn_from_pool() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT 1;")
+            await db_pool.check()
         except Exception as e:
-            logger.warning(f"Keep-alive falhou, reiniciando pool: {e}")
-            init_db_pool()
-        await asyncio.sleep(60)
+            logger.warning(f"Verificação do pool falhou: {e}")
 
-# Inicializa pool no startup
-init_db_pool()
+# Inicializa Database no import; o pool assíncrono é aberto no startup do app
+init_database()
 
 # -------------------------
 # Limites de proteção
@@ -108,56 +162,137 @@ init_db_pool()
 MAX_CONTEXT_TOKENS = 800
 MAX_PROMPT_LENGTH = 400
 MAX_RESPONSE_TOKENS = 2000
-MAX_CONCURRENT_REQUESTS = 1
+MAX_CONCURRENT_REQUESTS = DB_POOL_MAX  # /ask em paralelo até a capacidade do pool
 semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+# Executor dedicado às chamadas síncronas de db.ask, com threads já aquecidas
+db_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS, thread_name_prefix="db-ask")
 ENABLE_TOKEN_CHECK = True
+# Respostas já validadas, por pergunta normalizada (CONTEXT é fixo no processo)
+ASK_CACHE_SIZE = 512
+ASK_CACHE_TTL = 600  # 10 minutos
+ask_cache: TTLCache = TTLCache(maxsize=ASK_CACHE_SIZE, ttl=ASK_CACHE_TTL)
+
+in_flight_requests = 0
+
+@asynccontextmanager
+async def request_slot():
+    """Ocupa uma vaga de processamento ou responde 429 se todas estiverem em uso"""
+    global in_flight_requests
+    if semaphore.locked():
+        raise HTTPException(status_code=429, detail="Servidor ocupado. Tente novamente em instantes.")
+    async with semaphore:
+        in_flight_requests += 1
+        try:
+            yield
+        finally:
+            in_flight_requests -= 1
 
 # -------------------------
 # Funções utilitárias
 # -------------------------
-def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+@lru_cache(maxsize=8)
+def _get_encoding(model: str = "gpt-4o-mini"):
+    """Retorna o encoding do modelo, construído uma única vez por processo"""
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    return len(encoding.encode(text))
+        return tiktoken.get_encoding("cl100k_base")
+
+@lru_cache(maxsize=2048)
+def _count_cached(text: str, model: str) -> int:
+    return len(_get_encoding(model).encode(text))
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    return _count_cached(text, model)
 
-def truncate_context(ctx: str) -> str:
-    lines = ctx.strip().split("\n")
-    truncated = []
+def _truncate_context_by_lines(lines: list[str]) -> tuple[str, int]:
+    token_lens = [len(tokens) for tokens in _get_encoding().encode_ordinary_batch(lines)]
+    start = len(lines)
     token_count = 0
-    for line in reversed(lines):
-        token_count += len(tiktoken.get_encoding("cl100k_base").encode(line))
-        if token_count > MAX_CONTEXT_TOKENS:
+    for i in reversed(range(len(lines))):
+        if token_count + token_lens[i] > MAX_CONTEXT_TOKENS:
             break
-        truncated.insert(0, line)
-    return "\n".join(truncated)
+        token_count += token_lens[i]
+        start = i
+    return "\n".join(lines[start:]), token_count
+
+def truncate_context(ctx: str) -> tuple[str, int]:
+    """Mantém as últimas linhas completas de ctx que cabem em MAX_CONTEXT_TOKENS.
+
+    Retorna o texto truncado e sua contagem de tokens, evitando um segundo encode.
+    """
+    ctx = ctx.strip()
+    enc = _get_encoding()
+    ids = enc.encode_ordinary(ctx)
+    if len(ids) <= MAX_CONTEXT_TOKENS:
+        return ctx, len(ids)
+    tail_ids = ids[-MAX_CONTEXT_TOKENS:]
+    try:
+        tail, offsets = enc.decode_with_offsets(tail_ids)
+    except Exception:
+        return _truncate_context_by_lines(ctx.split("\n"))
+    # Descarta os tokens da primeira linha, que pode ter sido cortada no meio
+    newline = tail.find("\n")
+    cut = len(tail_ids)
+    if newline != -1:
+        cut = next((i for i, offset in enumerate(offsets) if offset > newline), cut)
+    if cut == len(tail_ids):
+        return "", 0
+    return tail[offsets[cut]:], len(tail_ids) - cut
+
+# Contexto é constante: trunca e conta tokens uma única vez
+CONTEXT_TRUNCATED, CONTEXT_TOKENS = truncate_context(CONTEXT)
+# Parte do orçamento de tokens que não depende da pergunta
+FIXED_TOKEN_BUDGET = CONTEXT_TOKENS + MAX_RESPONSE_TOKENS
+
+# Regexes de validação de SQL, compiladas uma única vez
+# SELECT de colunas simples (ou *) direto de ALLOWED_TABLE, em um único statement
+_SELECT_QUERY_RE = sql_re.compile(
+    r"(?is)^\s*select\s+(?P<cols>\*|[a-z_][a-z0-9_]*(?:\s*,\s*[a-z_][a-z0-9_]*)*)"
+    r"\s+from\s+(?:public\.)?" + re.escape(ALLOWED_TABLE) + r"\b[^;]*;?\s*$"
+)
+_DANGEROUS_RE = sql_re.compile(r"(?i)\b(" + "|".join(sorted(DANGEROUS_KEYWORDS)) + r")\b")
+_COLS_SPLIT_RE = re.compile(r"\s*,\s*")
+# Perguntas que já trazem um comando de escrita em SQL nunca chegam ao modelo
+_WRITE_INTENT_RE = re.compile(
+    r"\b(?:drop|truncate|alter)\s+table\b|\bdelete\s+from\b|\binsert\s+into\b|\bupdate\s+\S+\s+set\b",
+    re.IGNORECASE,
+)
 
 def validate_sql_query(query: str) -> bool:
-    q = query.lower()
-    if not q.strip().startswith("select"):
+    # Rejeita o que não é SELECT antes de rodar a regex na query inteira
+    if query.lstrip()[:6].lower() != "select":
         return False
-    if any(word in q for word in DANGEROUS_KEYWORDS):
+    match = _SELECT_QUERY_RE.search(query)
+    if not match:
         return False
-    if "public.students" not in q and "students" not in q:
+    if _DANGEROUS_RE.search(query):
         return False
-    match = re.search(r"select\s+(.*?)\s+from", q, re.DOTALL)
-    if match:
-        cols = match.group(1).replace(" ", "").split(",")
-        for col in cols:
-            if col != "*" and col not in ALLOWED_COLUMNS:
-                return False
-    return True
+    cols = set(_COLS_SPLIT_RE.split(match.group("cols").lower())) - {"*"}
+    return cols <= ALLOWED_COLUMNS
 
 # -------------------------
 # Inicializa FastAPI
 # -------------------------
-app = FastAPI(title="ToolFront Chat API")
+app = FastAPI(title="ToolFront Chat API", default_response_class=ORJSONResponse)
+
+pool_check_task: asyncio.Task | None = None
 
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(keep_alive())
-    logger.info("Keep-alive iniciado para manter conexões ativas.")
+    global pool_check_task
+    await init_db_pool()
+    pool_check_task = asyncio.create_task(check_pool_periodically())
+    logger.info("Verificação periódica do pool iniciada.")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if pool_check_task:
+        pool_check_task.cancel()
+    db_executor.shutdown(wait=False, cancel_futures=True)
+    if db_pool:
+        await db_pool.close()
+    logger.info("Executor de consultas e pool de conexões finalizados.")
 
 # -------------------------
 # CORS
@@ -173,55 +308,101 @@ origins = (
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=600,
 )
 
+# -------------------------
+# Compressão
+# -------------------------
+# Respostas com tabelas podem ter vários KB; respostas pequenas (ex.: /health) não são comprimidas
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # -------------------------
 # Modelo de request
 # -------------------------
 class AskRequest(BaseModel):
-    pergunta: str
+    # Validado no parsing pelo pydantic-core: pergunta vazia ou longa demais vira 422 sem tokenizar
+    pergunta: Annotated[str, StringConstraints(strip_whitespace=True, min_length=1, max_length=MAX_PROMPT_LENGTH)]
 
 # -------------------------
 # Endpoint /ask
 # -------------------------
+def prefers_plain_text(accept: str | None) -> bool:
+    """True só se o Accept der a text/plain q-value maior que ao JSON (empate fica com JSON)"""
+    if not accept:
+        return False
+    q_text = q_json = 0.0
+    for item in accept.split(","):
+        media, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        media = media.lower()
+        if media == "text/plain":
+            q_text = max(q_text, q)
+        if media in ("application/json", "application/*", "*/*"):
+            q_json = max(q_json, q)
+    return q_text > q_json
+
+def build_ask_response(texto: str, accept: str | None):
+    # db.ask não gera a resposta em partes; quem prefere texto puro evita o envelope JSON
+    if prefers_plain_text(accept):
+        return PlainTextResponse(texto)
+    return {"resposta": texto}
+
+async def ask_with_reconnect(pergunta: str):
+    """Roda db.ask no executor; entre tentativas recria o Database e aguarda sem ocupar thread"""
+    loop = asyncio.get_running_loop()
+    for attempt in range(3):
+        current = db
+        try:
+            return await loop.run_in_executor(
+                db_executor,
+                partial(current.ask, pergunta, model="gpt-4o-mini", context=CONTEXT_TRUNCATED)
+            )
+        except (psycopg.OperationalError, psycopg.InterfaceError) as e:
+            logger.warning(f"Conexão perdida (tentativa {attempt+1}): {e}. Reinicializando Database...")
+            await reset_database(stale=current)
+            if attempt < 2:
+                delay = 0.1 * (4 ** attempt)  # 0.1s, 0.4s
+                # Servidor desligando/reiniciando demora mais a voltar
+                if isinstance(e, psycopg.errors.AdminShutdown):
+                    delay *= 4
+                await asyncio.sleep(delay)
+    raise HTTPException(status_code=503, detail="Falha ao conectar ao banco após múltiplas tentativas.")
+
 @app.post("/ask")
-async def ask_question(request: AskRequest):
-    if not request.pergunta.strip():
-        raise HTTPException(status_code=400, detail="Pergunta não pode ser vazia.")
-    if len(request.pergunta) > MAX_PROMPT_LENGTH:
-        raise HTTPException(status_code=400, detail=f"Pergunta muito longa ({len(request.pergunta)} caracteres).")
+async def ask_question(request: AskRequest, accept: str | None = Header(default=None)):
+    if _WRITE_INTENT_RE.search(request.pergunta):
+        logger.warning(f"Pergunta bloqueada antes do modelo: {request.pergunta}")
+        raise HTTPException(status_code=400, detail="Pergunta não permitida por razões de segurança.")
 
-    context_truncado = truncate_context(CONTEXT)
+    cache_key = request.pergunta.lower()
+    cached = ask_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Pergunta respondida pelo cache")
+        return build_ask_response(cached, accept)
 
     if ENABLE_TOKEN_CHECK:
-        context_tokens = count_tokens(context_truncado)
         pergunta_tokens = count_tokens(request.pergunta)
-        total_tokens = context_tokens + pergunta_tokens + MAX_RESPONSE_TOKENS
-        logger.info(f"Tokens usados -> Contexto: {context_tokens}, Pergunta: {pergunta_tokens}, Máx Resposta: {MAX_RESPONSE_TOKENS}, Total: {total_tokens}")
+        total_tokens = FIXED_TOKEN_BUDGET + pergunta_tokens
+        logger.info(f"Tokens usados -> Contexto: {CONTEXT_TOKENS}, Pergunta: {pergunta_tokens}, Máx Resposta: {MAX_RESPONSE_TOKENS}, Total: {total_tokens}")
         if total_tokens > 128000:
             raise HTTPException(status_code=400, detail=f"Requisição excede limite de tokens ({total_tokens} > 128000).")
 
-    async with semaphore:
+    async with request_slot():
         start_time = time.time()
-        loop = asyncio.get_running_loop()
-
-        def ask_with_reconnect():
-            global db
-            for attempt in range(3):
-                try:
-                    return db.ask(request.pergunta, model="gpt-4o-mini", context=context_truncado)
-                except (psycopg.OperationalError, psycopg.InterfaceError) as e:
-                    logger.warning(f"Conexão perdida (tentativa {attempt+1}): {e}. Reinicializando db...")
-                    init_db_pool()
-                    time.sleep(1)
-            raise HTTPException(status_code=503, detail="Falha ao conectar ao banco após múltiplas tentativas.")
-
         try:
-            resposta = await loop.run_in_executor(None, ask_with_reconnect)
+            resposta = await ask_with_reconnect(request.pergunta)
 
             if hasattr(resposta, "sql"):
                 logger.info(f"[SQL Gerada] {resposta.sql}")
@@ -231,8 +412,12 @@ async def ask_question(request: AskRequest):
 
             elapsed = time.time() - start_time
             logger.info(f"Pergunta processada em {elapsed:.2f}s")
-            return {"resposta": str(resposta)}
+            texto = str(resposta)
+            ask_cache[cache_key] = texto
+            return build_ask_response(texto, accept)
 
+        except HTTPException:
+            raise
         except ModelRetry as mr:
             logger.warning(f"Retry do modelo: {mr}")
             raise HTTPException(status_code=503, detail="O modelo pediu retry. Tente novamente.")
@@ -243,23 +428,27 @@ async def ask_question(request: AskRequest):
 
 @app.post("/reconnect-db")
 async def reconnect_db():
-    """Força reinicialização do pool de conexões e do objeto Database"""
+    """Testa a conexão com SELECT 1; o pool só é recriado se a conexão estiver quebrada"""
     try:
-        with get_conn_from_pool() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT 1;")
+        await ping_db()
         return {"success": True, "db_connected": True}
     except Exception as e:
         logger.exception("Falha ao reconectar ao DB")
         return {"success": False, "db_connected": False, "error": str(e)}
 
 
+HEALTH_CACHE_SECONDS = 5
+last_health_ok = 0.0
+
 @app.get("/health")
 async def health_check():
+    global last_health_ok
+    # Probes frequentes reaproveitam o último SELECT 1 bem-sucedido
+    if time.monotonic() - last_health_ok < HEALTH_CACHE_SECONDS:
+        return {"status": "connected", "in_flight": in_flight_requests}
     try:
-        with get_conn_from_pool() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT 1;")
-        return {"status": "connected"}
+        await ping_db()
+        last_health_ok = time.monotonic()
+        return {"status": "connected", "in_flight": in_flight_requests}
     except Exception:
-        return {"status": "disconnected"}
+        return {"status": "disconnected", "in_flight": in_flight_requests}
@@ -1,4 +1,5 @@
 import os
+from collections import defaultdict
 import psycopg2
 from psycopg2 import sql
 from dotenv import load_dotenv
@@ -43,7 +44,7 @@ except Exception as e:
 # -------------------------
 def check_tables():
     cur.execute("SELECT tablename FROM pg_tables WHERE schemaname='public';")
-    existing_tables = [row[0] for row in cur.fetchall()]
+    existing_tables = {row[0] for row in cur.fetchall()}
     print("\n=== Verificação de Tabelas ===")
     for table in EXPECTED_TABLES.keys():
         if table in existing_tables:
@@ -56,14 +57,17 @@ def check_tables():
 # -------------------------
 def check_columns():
     print("\n=== Verificação de Colunas ===")
+    # Uma única consulta para todas as tabelas esperadas
+    cur.execute(
+        sql.SQL("SELECT table_name, column_name FROM information_schema.columns WHERE table_name = ANY(%s);"),
+        [list(EXPECTED_TABLES.keys())]
+    )
+    existing_cols = defaultdict(set)
+    for table, col in cur.fetchall():
+        existing_cols[table].add(col)
     for table, expected_cols in EXPECTED_TABLES.items():
-        cur.execute(
-            sql.SQL("SELECT column_name FROM information_schema.columns WHERE table_name = %s;"),
-            [table]
-        )
-        existing_cols = [row[0] for row in cur.fetchall()]
         for col in expected_cols:
-            if col in existing_cols:
+            if col in existing_cols[table]:
                 print(f"[OK] Coluna '{col}' em '{table}' encontrada")
             else:
                 print(f"[ERRO] Coluna '{col}' em '{table}' NÃO encontrada")